@@ -0,0 +1,257 @@
+import contextlib
+import fnmatch
+import functools
+import hashlib
+import mmap
+import os
+import re
+import shutil
+import subprocess
+from typing import BinaryIO, FrozenSet, Iterator, List, Optional, Union
+
+import yaml
+from celery.utils.log import get_task_logger
+
+logger = get_task_logger(__name__)
+
+RULE_EXTENSIONS = (".yml", ".yaml")
+# Above this many literals nearly every line carries one of them and the
+# filter stops paying for itself.
+MAX_FILTER_LITERALS = 5000
+GREP_PATH = shutil.which("grep")
+# Modifiers whose values don't appear verbatim (ignoring case) in the log line.
+SAFE_MODIFIERS = {"contains", "startswith", "endswith", "all"}
+# The libyaml-backed loader is several times faster when it was built.
+_YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+
+def _rule_files(rules_path: str) -> List[str]:
+    rule_files = []
+    for directory, _, filenames in os.walk(rules_path):
+        for filename in filenames:
+            if filename.endswith(RULE_EXTENSIONS):
+                rule_files.append(os.path.join(directory, filename))
+    return sorted(rule_files)
+
+
+def load_rule_documents(rules_path: str) -> Optional[List[dict]]:
+    """Parse every Sigma rule below rules_path, or None if any can't be read."""
+    documents = []
+    for rule_file in _rule_files(rules_path):
+        try:
+            with open(rule_file, "rb") as handle:
+                document = yaml.load(handle, Loader=_YAML_LOADER)
+        except (OSError, yaml.YAMLError) as exc:
+            logger.warning("Unable to parse Sigma rule %s: %s", rule_file, exc)
+            return None
+        if not isinstance(document, dict):
+            return None
+        documents.append(document)
+    return documents
+
+
+def _literal_fragments(value: str) -> List[str]:
+    # Split on unescaped wildcards. Sigma escapes them as \* and \? (and a
+    # backslash as \\); any other backslash is a literal character.
+    fragments = []
+    current = []
+    index = 0
+    while index < len(value):
+        char = value[index]
+        if char == "\\" and value[index + 1 : index + 2] in ("*", "?", "\\"):
+            current.append(value[index + 1])
+            index += 2
+            continue
+        if char in "*?":
+            fragments.append("".join(current))
+            current = []
+        else:
+            current.append(char)
+        index += 1
+    fragments.append("".join(current))
+    return [fragment for fragment in fragments if fragment]
+
+
+def _value_literal(value) -> Optional[str]:
+    if not isinstance(value, str):
+        return None
+    fragments = _literal_fragments(value)
+    if not fragments:
+        return None
+    literal = max(fragments, key=len)
+    # Sigma matching is case-insensitive; only ASCII folds safely on bytes.
+    return literal if literal.isascii() else None
+
+
+def _values_literals(values) -> Optional[List[str]]:
+    if not isinstance(values, list):
+        values = [values]
+    literals = [_value_literal(value) for value in values]
+    if not literals or None in literals:
+        return None
+    return literals
+
+
+def _selection_literals(selection) -> Optional[List[str]]:
+    if isinstance(selection, list):
+        # Keyword list or list of maps: any alternative may match, so every
+        # alternative needs a literal of its own.
+        literals = []
+        for alternative in selection:
+            if isinstance(alternative, dict):
+                alternative_literals = _selection_literals(alternative)
+            else:
+                alternative_literals = _values_literals(alternative)
+            if alternative_literals is None:
+                return None
+            literals.extend(alternative_literals)
+        return literals or None
+
+    if isinstance(selection, dict):
+        # Fields are ANDed, so one field whose values all carry a literal is
+        # enough to gate the whole map.
+        for field, values in selection.items():
+            modifiers = str(field).split("|")[1:]
+            if not SAFE_MODIFIERS.issuperset(modifiers):
+                continue
+            literals = _values_literals(values)
+            if literals is not None:
+                return literals
+        return None
+
+    return _values_literals(selection)
+
+
+def _negated_selections(tokens: List[str]) -> List[str]:
+    negated = []
+    for position, token in enumerate(tokens[:-1]):
+        if token != "not":
+            continue
+        operand = tokens[position + 1 :]
+        # "not 1 of filter*" / "not all of filter*"
+        if len(operand) >= 3 and operand[1] == "of":
+            negated.append(operand[2])
+        else:
+            negated.append(operand[0])
+    return negated
+
+
+def _rule_literals(document: dict) -> Optional[List[str]]:
+    detection = document.get("detection")
+    if not isinstance(detection, dict):
+        return None
+
+    condition = detection.get("condition", "")
+    if isinstance(condition, list):
+        condition = " or ".join(str(part) for part in condition)
+    tokens = re.findall(r"[\w*]+", str(condition).lower())
+    # "a and not b" still needs a to match, but "not b" or "a or not b" can
+    # fire on lines that carry none of the rule's literals.
+    if "not" in tokens and (tokens[0] == "not" or "or" in tokens):
+        return None
+    negated = _negated_selections(tokens)
+
+    literals = []
+    for name, selection in detection.items():
+        if name in ("condition", "timeframe"):
+            continue
+        if any(fnmatch.fnmatchcase(name.lower(), pattern) for pattern in negated):
+            # Only ever excludes lines, so it needs no literal of its own.
+            continue
+        selection_literals = _selection_literals(selection)
+        if selection_literals is None:
+            return None
+        literals.extend(selection_literals)
+    return literals or None
+
+
+def extract_literals(documents: List[dict]) -> Optional[FrozenSet[str]]:
+    """Collect literals so that every line a rule can match contains one of them.
+
+    Returns None when at least one rule can match without any literal, in which
+    case no line may be dropped.
+    """
+    literals = set()
+    for document in documents:
+        rule_literals = _rule_literals(document)
+        if rule_literals is None:
+            logger.info(
+                "Sigma rule %s cannot be reduced to literals; line filter disabled",
+                document.get("id") or document.get("title"),
+            )
+            return None
+        literals.update(literal.lower() for literal in rule_literals)
+    return frozenset(literals)
+
+
+@functools.lru_cache(maxsize=32)
+def line_filter(rules_path: str, fingerprint: str) -> Optional[FrozenSet[str]]:
+    """Return literals one of which is on every line the rules may detect.
+
+    fingerprint is rules_fingerprint(rules_path); it only keys the cache, so
+    the filter is rebuilt as soon as a rule is added or edited.
+    """
+    if GREP_PATH is None:
+        logger.warning("grep is not installed; line filter disabled")
+        return None
+
+    documents = load_rule_documents(rules_path)
+    if not documents:
+        return None
+
+    literals = extract_literals(documents)
+    if not literals or len(literals) > MAX_FILTER_LITERALS:
+        return None
+    return literals
+
+
+@contextlib.contextmanager
+def mapped_file(file_path: str) -> Iterator[Union[mmap.mmap, bytes]]:
+    """Map file_path read-only so scanning it doesn't copy it into the heap."""
+    with open(file_path, "rb") as handle:
+        if os.fstat(handle.fileno()).st_size == 0:
+            # mmap refuses empty files.
+            yield b""
+            return
+        with mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            yield mapped
+
+
+def write_matching_lines(
+    literals: FrozenSet[str], source_path: str, target: BinaryIO
+) -> None:
+    """Copy the lines of source_path that contain one of literals to target.
+
+    Matching ignores ASCII case, like the literals. grep -F searches for all
+    literals in a single pass over the file and runs outside the GIL, so
+    files filtered on different threads are filtered concurrently.
+    """
+    target.flush()
+    result = subprocess.run(
+        [GREP_PATH, "-F", "-i", "-a", "-f", "-", "--", source_path],
+        input="\n".join(sorted(literals)).encode("ascii"),
+        stdout=target,
+        stderr=subprocess.PIPE,
+        # Byte semantics and the fast matcher; a UTF-8 locale slows grep -i.
+        env={"LC_ALL": "C"},
+        check=False,
+    )
+    # grep exits 1 when no line matched.
+    if result.returncode > 1:
+        raise OSError(
+            f"grep failed on {source_path}: {result.stderr.decode('utf-8', 'replace')}"
+        )
+
+
+def rules_fingerprint(rules_path: str) -> str:
+    """Digest the names, mtimes and sizes of every file below rules_path."""
+    digest = hashlib.sha1(os.path.abspath(rules_path).encode("utf-8"))
+    for directory, _, filenames in sorted(os.walk(rules_path)):
+        for filename in sorted(filenames):
+            file_path = os.path.join(directory, filename)
+            stat_result = os.stat(file_path)
+            relative_path = os.path.relpath(file_path, rules_path)
+            digest.update(
+                f"{relative_path}\0{stat_result.st_mtime_ns}\0{stat_result.st_size}\n".encode()
+            )
+    return digest.hexdigest()
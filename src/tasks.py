@@ -1,7 +1,16 @@
+import contextvars
+import functools
+import hashlib
+import logging
 import os
+import shlex
+import shutil
 import subprocess
-from pathlib import Path
-from typing import Dict, List, Optional
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, FrozenSet, List, NamedTuple, Optional
 
 from celery import signals
 from celery.utils.log import get_task_logger
@@ -14,6 +23,12 @@ from openrelik_worker_common.task_utils import (
 )
 
 from .app import celery
+from .rules import (
+    line_filter,
+    mapped_file,
+    rules_fingerprint,
+    write_matching_lines,
+)
 
 
 WORKER_NAME = "openrelik-worker-chopchopgo"
@@ -23,17 +38,32 @@ SUPPORTED_TARGETS = ["syslog", "auditd"]
 DEFAULT_TARGET = os.getenv("CHOPCHOPGO_DEFAULT_TARGET", "syslog")
 DEFAULT_RULES_ROOT = os.getenv("CHOPCHOPGO_RULES_DIR", "/opt/chopchopgo/rules")
 BINARY_PATH = os.getenv("CHOPCHOPGO_BINARY", "chopchopgo")
-
+# ChopChopGo processes per task. The prefork pool already runs one task per
+# CPU and every ChopChopGo process uses all CPUs, so keep this small.
+PARALLELISM = int(os.getenv("CHOPCHOPGO_PARALLELISM", "2"))
+PROGRESS_UPDATES = 20
+CACHE_DIR = os.getenv("CHOPCHOPGO_CACHE")
+# Cached outputs unused for this many days are deleted; every hit refreshes
+# an entry's mtime.
+CACHE_MAX_AGE_DAYS = float(os.getenv("CHOPCHOPGO_CACHE_MAX_AGE_DAYS", "30"))
+# Each worker process sweeps the cache at most this often.
+CACHE_PRUNE_INTERVAL = 3600
+PREFILTER = os.getenv("CHOPCHOPGO_PREFILTER") == "1"
+# auditd records hex-encode fields such as proctitle, which ChopChopGo decodes
+# before matching, so rule literals can't be searched for in raw auditd lines.
+PREFILTER_TARGETS = {"syslog"}
+
+DEFAULT_RULE_SUBPATH = os.path.join("linux", "builtin")
 TARGET_RULE_SUBPATHS = {
-    "syslog": Path("linux") / "builtin",
-    "auditd": Path("linux") / "auditd",
+    "syslog": DEFAULT_RULE_SUBPATH,
+    "auditd": os.path.join("linux", "auditd"),
 }
 RULE_BUNDLE_SUBPATHS = {
-    "linux/builtin": Path("linux") / "builtin",
-    "linux/auditd": Path("linux") / "auditd",
-    "linux/process_creation": Path("linux") / "process_creation",
-    "linux/file_event": Path("linux") / "file_event",
-    "linux/network_connection": Path("linux") / "network_connection",
+    "linux/builtin": DEFAULT_RULE_SUBPATH,
+    "linux/auditd": os.path.join("linux", "auditd"),
+    "linux/process_creation": os.path.join("linux", "process_creation"),
+    "linux/file_event": os.path.join("linux", "file_event"),
+    "linux/network_connection": os.path.join("linux", "network_connection"),
 }
 
 TASK_METADATA = {
@@ -82,25 +112,53 @@ TASK_METADATA = {
 COMPATIBLE_INPUTS = {
     "data_types": [],
     "mime_types": ["text/plain", "application/octet-stream"],
-    "filenames": ["*.log", "*.txt", "*"],
+    "filenames": ["*"],
 }
 
-log_root = Logger()
-logger = log_root.get_logger(__name__, get_task_logger(__name__))
-
 
-def _first_value(value):
-    if isinstance(value, list):
-        return value[0] if value else None
-    return value
+class _TaskConfig(NamedTuple):
+    output_format: str
+    target: str
+    rules_override: Optional[str]
+    bundle_choice: Optional[str]
 
 
-def _determine_output_format(task_config: Optional[Dict[str, str]]) -> str:
-    raw_value = _first_value((task_config or {}).get("output_format"))
+log_root = Logger()
+task_logger = get_task_logger(__name__)
+logger = log_root.get_logger(__name__, task_logger)
+
+# Resolved once per worker process by on_worker_process_init; while unset the
+# binary and rule bundles are looked up on every task.
+_BINARY_ABS: Optional[str] = None
+_BUNDLE_ROOT: Optional[str] = None
+_BUNDLE_DIRS: Optional[Dict[str, str]] = None
+# time.monotonic() of this process' last sweep of CACHE_DIR.
+_CACHE_PRUNED_AT: Optional[float] = None
+
+
+def _normalize_config(task_config: Optional[Dict]) -> Dict[str, Optional[str]]:
+    """Reduce every task_config value to a single optional string.
+
+    Autocomplete fields arrive as lists; only their first entry is used.
+    Values that are not scalars are ignored.
+    """
+    normalized: Dict[str, Optional[str]] = {}
+    for key, value in (task_config or {}).items():
+        if isinstance(value, list):
+            value = value[0] if value else None
+        if value is not None and not isinstance(value, (str, int, float)):
+            logger.warning("Ignoring unsupported value for %s: %r", key, value)
+            value = None
+        normalized[key] = None if value is None else str(value)
+    return normalized
+
+
+def _determine_output_format(config: Dict[str, Optional[str]]) -> str:
+    raw_value = config.get("output_format")
     if raw_value is None:
         return "json"
 
-    configured = str(raw_value).strip().lower()
+    configured = raw_value.strip().lower()
     if configured in SUPPORTED_FORMATS:
         return configured
 
@@ -111,12 +169,12 @@ def _determine_output_format(task_config: Optional[Dict[str, str]]) -> str:
     return "json"
 
 
-def _determine_target(task_config: Optional[Dict[str, str]]) -> str:
-    raw_value = _first_value((task_config or {}).get("target"))
+def _determine_target(config: Dict[str, Optional[str]]) -> str:
+    raw_value = config.get("target")
     if raw_value is None:
         return DEFAULT_TARGET
 
-    target_candidate = str(raw_value).strip()
+    target_candidate = raw_value.strip()
     if not target_candidate:
         return DEFAULT_TARGET
 
@@ -129,27 +187,413 @@ def _determine_target(task_config: Optional[Dict[str, str]]) -> str:
     return target_candidate
 
 
-def _resolve_rules_path(
+def _locate_binary() -> str:
+    binary_path = shutil.which(BINARY_PATH)
+    if binary_path is None:
+        logger.error("ChopChopGo binary '%s' not found", BINARY_PATH)
+        return BINARY_PATH
+    return os.path.realpath(binary_path)
+
+
+def _discover_bundle_dirs(rules_root: str) -> Dict[str, str]:
+    # Bundles share parent directories (all live under "linux"), so list each
+    # parent once instead of probing every bundle path separately.
+    subpaths_by_parent: Dict[str, List[str]] = {}
+    for subpath in RULE_BUNDLE_SUBPATHS.values():
+        subpaths_by_parent.setdefault(os.path.dirname(subpath), []).append(subpath)
+
+    bundle_dirs = {}
+    for parent, subpaths in subpaths_by_parent.items():
+        parent_dir = os.path.join(rules_root, parent)
+        try:
+            with os.scandir(parent_dir) as entries:
+                child_dirs = {entry.name for entry in entries if entry.is_dir()}
+        except OSError:
+            continue
+
+        for subpath in subpaths:
+            if os.path.basename(subpath) in child_dirs:
+                bundle_dirs[subpath] = os.path.join(rules_root, subpath)
+    return bundle_dirs
+
+
+def _bundle_dir(rules_root: str, subpath: str) -> Optional[str]:
+    use_snapshot = _BUNDLE_DIRS is not None and rules_root == _BUNDLE_ROOT
+    # Bundles found at start-up are trusted without another stat; a miss is
+    # probed again since the bundle may have been installed since then.
+    if use_snapshot and subpath in _BUNDLE_DIRS:
+        return _BUNDLE_DIRS[subpath]
+
+    candidate = os.path.join(rules_root, subpath)
+    if not os.path.isdir(candidate):
+        return None
+    if use_snapshot:
+        _BUNDLE_DIRS[subpath] = candidate
+    return candidate
+
+
+def _parse_config(task_config: Optional[Dict]) -> _TaskConfig:
+    config = _normalize_config(task_config)
+    return _TaskConfig(
+        output_format=_determine_output_format(config),
+        target=_determine_target(config),
+        rules_override=config.get("rules_path"),
+        bundle_choice=config.get("rule_bundle"),
+    )
+
+
+@functools.lru_cache(maxsize=256)
+def _resolve_rules_path_cached(
+    rules_root: str,
     target: str,
     rules_override: Optional[str],
     bundle_choice: Optional[str],
 ) -> Optional[str]:
     if rules_override:
-        override_path = Path(rules_override)
-        return str(override_path) if override_path.is_dir() else None
+        return rules_override if os.path.isdir(rules_override) else None
 
-    bundle_key = _first_value(bundle_choice)
-    if bundle_key:
-        subpath = RULE_BUNDLE_SUBPATHS.get(bundle_key)
+    if bundle_choice:
+        subpath = RULE_BUNDLE_SUBPATHS.get(bundle_choice)
         if subpath:
-            candidate = Path(DEFAULT_RULES_ROOT) / subpath
-            if candidate.is_dir():
-                return str(candidate)
+            candidate = _bundle_dir(rules_root, subpath)
+            if candidate:
+                return candidate
+
+    default_subpath = TARGET_RULE_SUBPATHS.get(target, DEFAULT_RULE_SUBPATH)
+    return _bundle_dir(rules_root, default_subpath)
+
+
+def _resolve_rules_path(
+    target: str,
+    rules_override: Optional[str],
+    bundle_choice: Optional[str],
+) -> Optional[str]:
+    rules_path = _resolve_rules_path_cached(
+        DEFAULT_RULES_ROOT, target, rules_override, bundle_choice
+    )
+    bundle_subpath = RULE_BUNDLE_SUBPATHS.get(bundle_choice) if bundle_choice else None
+    fell_back = (
+        rules_path is not None
+        and not rules_override
+        and bundle_subpath is not None
+        and rules_path != os.path.join(DEFAULT_RULES_ROOT, bundle_subpath)
+    )
+    if rules_path is None or fell_back:
+        # Don't remember misses, including a requested bundle that was
+        # replaced by the target's default: it may be mounted later on.
+        _resolve_rules_path_cached.cache_clear()
+    return rules_path
+
+
+def _build_command(
+    target: str, rules_path: str, file_path: str, output_format: str
+) -> List[str]:
+    return [
+        _BINARY_ABS or BINARY_PATH,
+        "-target",
+        target,
+        "-rules",
+        rules_path,
+        "-file",
+        file_path,
+        "-out",
+        output_format,
+    ]
+
+
+def _run_chopchopgo(
+    command: List[str], output_file_path: str, target: str, display_name: str
+) -> None:
+    # The structlog wrapper runs its processors before the stdlib level check,
+    # so ask the underlying logger first on this per-file path.
+    debug_enabled = task_logger.isEnabledFor(logging.DEBUG)
+    if debug_enabled:
+        logger.debug("Running ChopChopGo command: %s", command)
+
+    with open(output_file_path, "wb") as output_handle:
+        result = subprocess.run(
+            command,
+            stdout=output_handle,
+            stderr=subprocess.PIPE,
+            check=False,
+        )
+    # stdout never passes through Python; stderr is only decoded when it is
+    # going to be reported.
+    returncode = result.returncode
+    stderr = ""
+    if result.stderr and (returncode != 0 or debug_enabled):
+        stderr = result.stderr.decode("utf-8", "replace")
+
+    if returncode != 0:
+        logger.error("ChopChopGo failed for %s: %s", display_name, stderr)
+
+        if "Failed to match timestamp" in stderr:
+            raise RuntimeError(
+                "ChopChopGo could not parse the input log format. "
+                "Verify the selected target (currently '%s') matches the log type "
+                "or supply a compatible ruleset." % target
+            )
+
+        raise RuntimeError(
+            f"ChopChopGo exited with code {returncode} while processing {display_name}"
+        )
+
+    if stderr and debug_enabled:
+        logger.debug("ChopChopGo stderr for %s: %s", display_name, stderr)
+
+
+def _prefilter_enabled(target: str) -> bool:
+    return PREFILTER and target in PREFILTER_TARGETS
+
 
-    default_subpath = TARGET_RULE_SUBPATHS.get(target, Path("linux") / "builtin")
-    candidate = Path(DEFAULT_RULES_ROOT) / default_subpath
+def _line_filter(
+    target: str, rules_path: str, fingerprint: Optional[str]
+) -> Optional[FrozenSet[str]]:
+    """Return the literals used to drop lines no rule can match, if enabled."""
+    if not fingerprint or not _prefilter_enabled(target):
+        return None
+    return line_filter(rules_path, fingerprint)
 
-    return str(candidate) if candidate.is_dir() else None
+
+def _file_digest(file_path: str) -> str:
+    with mapped_file(file_path) as data:
+        return hashlib.sha1(data).hexdigest()
+
+
+def _cache_salt(
+    target: str, output_format: str, fingerprint: Optional[str]
+) -> Optional[str]:
+    """Digest everything besides the input that determines ChopChopGo's output."""
+    if not CACHE_DIR or not fingerprint:
+        return None
+
+    binary_path = _BINARY_ABS or shutil.which(BINARY_PATH) or BINARY_PATH
+    try:
+        binary_mtime = os.stat(binary_path).st_mtime_ns
+    except OSError:
+        binary_mtime = 0
+    identity = "\0".join(
+        [
+            os.path.realpath(binary_path),
+            str(binary_mtime),
+            fingerprint,
+            target,
+            output_format,
+        ]
+    )
+    return hashlib.sha1(identity.encode("utf-8")).hexdigest()
+
+
+def _cache_key(file_path: str, cache_salt: Optional[str]) -> Optional[str]:
+    if not cache_salt:
+        return None
+    return f"{_file_digest(file_path)}-{cache_salt}"
+
+
+def _link_or_copy(source: str, destination: str) -> None:
+    try:
+        os.link(source, destination)
+    except OSError:
+        # Different filesystems (or no hardlink support): fall back to a copy.
+        shutil.copyfile(source, destination)
+
+
+def _restore_cached_output(cache_key: str, output_file_path: str) -> bool:
+    cached_path = os.path.join(CACHE_DIR, cache_key)
+    try:
+        os.utime(cached_path)
+        _link_or_copy(cached_path, output_file_path)
+    except FileNotFoundError:
+        # Never cached, or pruned by another worker process in the meantime.
+        return False
+    return True
+
+
+def _store_cached_output(cache_key: str, output_file_path: str) -> None:
+    cached_path = os.path.join(CACHE_DIR, cache_key)
+    staging_path = f"{cached_path}.{os.getpid()}.{threading.get_ident()}"
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        _link_or_copy(output_file_path, staging_path)
+        os.replace(staging_path, cached_path)
+    except OSError as exc:
+        logger.warning("Unable to cache ChopChopGo output in %s: %s", CACHE_DIR, exc)
+
+
+def _prune_cache() -> None:
+    global _CACHE_PRUNED_AT
+
+    now = time.monotonic()
+    if _CACHE_PRUNED_AT is not None and now - _CACHE_PRUNED_AT < CACHE_PRUNE_INTERVAL:
+        return
+    _CACHE_PRUNED_AT = now
+
+    cutoff = time.time() - CACHE_MAX_AGE_DAYS * 86400
+    removed = 0
+    try:
+        with os.scandir(CACHE_DIR) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_file() and entry.stat().st_mtime < cutoff:
+                        os.unlink(entry.path)
+                        removed += 1
+                except FileNotFoundError:
+                    # Removed by another worker process sweeping concurrently.
+                    continue
+    except FileNotFoundError:
+        return
+    if removed:
+        logger.info("Removed %d expired ChopChopGo output(s) from %s", removed, CACHE_DIR)
+
+
+def _scan_file(
+    file_path: str,
+    target: str,
+    rules_path: str,
+    output_format: str,
+    output_file_path: str,
+    display_name: str,
+    literals: Optional[FrozenSet[str]],
+) -> List[str]:
+    command = _build_command(target, rules_path, file_path, output_format)
+    if literals is None:
+        _run_chopchopgo(command, output_file_path, target, display_name)
+        return command
+
+    with tempfile.NamedTemporaryFile(
+        prefix="chopchopgo-filtered-", suffix=".log"
+    ) as filtered:
+        write_matching_lines(literals, file_path, filtered)
+        # Record the command against the original input; the filtered copy
+        # is an implementation detail that is gone once the scan finishes.
+        filtered_command = _build_command(
+            target, rules_path, filtered.name, output_format
+        )
+        _run_chopchopgo(filtered_command, output_file_path, target, display_name)
+    return command
+
+
+def _process_one(
+    input_file: Dict,
+    target: str,
+    rules_path: str,
+    output_format: str,
+    output_path: Optional[str],
+    literals: Optional[FrozenSet[str]] = None,
+    cache_salt: Optional[str] = None,
+) -> Optional[Dict]:
+    file_path = input_file.get("path")
+    if not file_path:
+        logger.warning("Skipping input without path: %s", input_file)
+        return None
+
+    display_name = input_file.get("display_name") or os.path.basename(file_path)
+    stem = os.path.splitext(os.path.basename(display_name))[0]
+    output_display_name = f"{stem}_chopchopgo"
+
+    output_file = create_output_file(
+        output_path,
+        display_name=output_display_name,
+        extension=output_format,
+        data_type=f"openrelik:chopchopgo:{output_format}",
+    )
+
+    cache_key = _cache_key(file_path, cache_salt)
+    if cache_key and _restore_cached_output(cache_key, output_file.path):
+        logger.info("Reusing cached ChopChopGo output for %s", display_name)
+        command = _build_command(target, rules_path, file_path, output_format)
+    else:
+        command = _scan_file(
+            file_path,
+            target,
+            rules_path,
+            output_format,
+            output_file.path,
+            display_name,
+            literals,
+        )
+        if cache_key:
+            _store_cached_output(cache_key, output_file.path)
+
+    return {
+        "display_name": display_name,
+        "output_file": output_file.to_dict(),
+        "command": command,
+    }
+
+
+def _process_files(
+    task,
+    files: List[Dict],
+    target: str,
+    rules_path: str,
+    output_format: str,
+    output_path: Optional[str],
+    literals: Optional[FrozenSet[str]] = None,
+    cache_salt: Optional[str] = None,
+) -> List[Dict]:
+    total_files = len(files)
+    results: List[Optional[Dict]] = [None] * total_files
+    finished = 0
+    # Every event is a broker publish; report roughly every 5% of the files.
+    progress_stride = max(1, total_files // PROGRESS_UPDATES)
+
+    with ThreadPoolExecutor(max_workers=max(1, min(total_files, PARALLELISM))) as executor:
+        # Each worker thread runs in a copy of the current context so the
+        # workflow/task ids bound to the logger are kept on every log line.
+        futures = {
+            executor.submit(
+                contextvars.copy_context().run,
+                _process_one,
+                input_file,
+                target,
+                rules_path,
+                output_format,
+                output_path,
+                literals,
+                cache_salt,
+            ): position
+            for position, input_file in enumerate(files)
+        }
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception:
+                executor.shutdown(wait=False, cancel_futures=True)
+                raise
+
+            results[futures[future]] = result
+            finished += 1
+            if finished % progress_stride and finished != total_files:
+                continue
+
+            task.send_event(
+                "task-progress",
+                data={
+                    "current": finished,
+                    "total": total_files,
+                    "message": f"Processed {finished} of {total_files} file(s)",
+                },
+            )
+
+    return [result for result in results if result is not None]
+
+
+@signals.worker_process_init.connect
+def on_worker_process_init(**_):
+    global _BINARY_ABS, _BUNDLE_ROOT, _BUNDLE_DIRS
+
+    _BINARY_ABS = _locate_binary()
+    _BUNDLE_ROOT = DEFAULT_RULES_ROOT
+    _BUNDLE_DIRS = _discover_bundle_dirs(DEFAULT_RULES_ROOT)
+    _resolve_rules_path_cached.cache_clear()
+
+    if not _BUNDLE_DIRS:
+        logger.error("No ChopChopGo rule bundles found under %s", DEFAULT_RULES_ROOT)
+
+    if PREFILTER:
+        for bundle_dir in _BUNDLE_DIRS.values():
+            line_filter(bundle_dir, rules_fingerprint(bundle_dir))
 
 
 @signals.task_prerun.connect
@@ -177,90 +621,37 @@ def analyze_logs(
     if not files:
         raise RuntimeError("No compatible input files provided to ChopChopGo")
 
-    output_format = _determine_output_format(task_config)
-    target = _determine_target(task_config)
-    rules_path = _resolve_rules_path(
-        target,
-        (task_config or {}).get("rules_path"),
-        (task_config or {}).get("rule_bundle"),
-    )
+    config = _parse_config(task_config)
+    output_format = config.output_format
+    target = config.target
+    rules_path = _resolve_rules_path(target, config.rules_override, config.bundle_choice)
 
     if not rules_path:
         raise RuntimeError(
             "Unable to locate rules directory. Select a bundled rule directory or provide 'rules_path'."
         )
 
-    output_files = []
-
-    total_files = len(files)
-
-    for index, input_file in enumerate(files, start=1):
-        file_path = input_file.get("path")
-        if not file_path:
-            logger.warning("Skipping input without path: %s", input_file)
-            continue
-
-        display_name = input_file.get("display_name") or Path(file_path).name
-        output_display_name = f"{Path(display_name).stem}_chopchopgo"
-
-        output_file = create_output_file(
-            output_path,
-            display_name=output_display_name,
-            extension=output_format,
-            data_type=f"openrelik:chopchopgo:{output_format}",
-        )
-
-        command = [
-            BINARY_PATH,
-            "-target",
-            target,
-            "-rules",
-            rules_path,
-            "-file",
-            file_path,
-            "-out",
-            output_format,
-        ]
-
-        logger.debug("Running ChopChopGo command: %s", command)
-
-        result = subprocess.run(
-            command,
-            capture_output=True,
-            text=True,
-            check=False,
-        )
-
-        if result.returncode != 0:
-            error_output = result.stderr or result.stdout or ""
-            logger.error("ChopChopGo failed for %s: %s", file_path, error_output)
-
-            if "Failed to match timestamp" in error_output:
-                raise RuntimeError(
-                    "ChopChopGo could not parse the input log format. "
-                    "Verify the selected target (currently '%s') matches the log type "
-                    "or supply a compatible ruleset." % target
-                )
-
-            raise RuntimeError(
-                f"ChopChopGo exited with code {result.returncode} while processing {display_name}"
-            )
-
-        if result.stderr:
-            logger.debug("ChopChopGo stderr for %s: %s", file_path, result.stderr)
-
-        output_data = result.stdout or ""
-        Path(output_file.path).write_text(output_data, encoding="utf-8")
+    # The filter and the cache follow the rules as they are now, but walking
+    # the rules directory is not free, so it happens once per task.
+    fingerprint = None
+    if CACHE_DIR or _prefilter_enabled(target):
+        fingerprint = rules_fingerprint(rules_path)
+    if CACHE_DIR:
+        _prune_cache()
+
+    processed = _process_files(
+        self,
+        files,
+        target,
+        rules_path,
+        output_format,
+        output_path,
+        _line_filter(target, rules_path, fingerprint),
+        _cache_salt(target, output_format, fingerprint),
+    )
 
-        output_files.append(output_file.to_dict())
-        self.send_event(
-            "task-progress",
-            data={
-                "current": index,
-                "total": total_files,
-                "message": f"Processed {display_name}",
-            },
-        )
+    output_files = [result["output_file"] for result in processed]
+    commands_run = [shlex.join(result["command"]) for result in processed]
 
     if not output_files:
         raise RuntimeError("ChopChopGo did not produce any outputs")
@@ -272,10 +663,11 @@ def analyze_logs(
     return create_task_result(
         output_files=output_files,
         workflow_id=workflow_id,
-        command=" ".join(command),
+        command=commands_run[-1],
         meta={
             "output_format": output_format,
             "target": target,
             "rules_path": rules_path,
+            "commands": commands_run,
         },
     )
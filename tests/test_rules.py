@@ -0,0 +1,174 @@
+from pathlib import Path
+
+import pytest
+
+from src import rules
+
+
+FIXTURES = Path(__file__).resolve().parent / "fixtures"
+
+CLEAR_SYSLOG_RULE = """
+title: Commands to Clear or Remove the Syslog
+id: e09eb557-96d2-4de9-ba2d-30f712a5afd3
+detection:
+  keywords:
+    - 'rm /var/log/syslog'
+    - 'rm -r /var/log/syslog'
+  condition: keywords
+"""
+
+PROMISC_RULE = """
+title: Promiscuous Mode
+id: f64b6e9a-5d9d-48a5-8289-e1dd2b3876e1
+detection:
+  selection:
+    Message|contains|all:
+      - 'entered'
+      - 'promiscuous mode'
+  filter:
+    Message|re: 'ignored.*'
+  condition: selection and not filter
+"""
+
+
+@pytest.fixture
+def rules_dir(tmp_path):
+    rules_root = tmp_path / "rules"
+    rules_root.mkdir()
+    (rules_root / "clear_syslog.yml").write_text(CLEAR_SYSLOG_RULE, encoding="utf-8")
+    rules.line_filter.cache_clear()
+    yield rules_root
+    rules.line_filter.cache_clear()
+
+
+def test_extract_literals_collects_keywords_and_fields():
+    literals = rules.extract_literals(
+        [
+            {"detection": {"keywords": ["*Wget*--post-file*"], "condition": "keywords"}},
+            {
+                "detection": {
+                    "selection": {"Image|endswith": "/nc", "CommandLine|re": ".*"},
+                    "condition": "selection",
+                }
+            },
+        ]
+    )
+
+    assert literals == {"--post-file", "/nc"}
+
+
+@pytest.mark.parametrize(
+    "detection",
+    [
+        {"selection": {"Message": "foo"}, "filter": {"Message": "bar"}, "condition": "not filter"},
+        {"selection": {"CommandLine|re": "rm .*"}, "condition": "selection"},
+        {"keywords": ["*"], "condition": "keywords"},
+        {"selection": {"EventID": 4688}, "condition": "selection"},
+    ],
+)
+def test_extract_literals_refuses_rules_without_literals(detection):
+    assert rules.extract_literals([{"detection": detection}]) is None
+
+
+def _line_filter(rules_dir):
+    return rules.line_filter(str(rules_dir), rules.rules_fingerprint(str(rules_dir)))
+
+
+def _filter(literals, source_path, tmp_path) -> bytes:
+    filtered_path = tmp_path / "filtered.log"
+    with open(filtered_path, "wb") as filtered:
+        rules.write_matching_lines(literals, str(source_path), filtered)
+    return filtered_path.read_bytes()
+
+
+def test_line_filter_keeps_only_candidate_lines(rules_dir, tmp_path):
+    literals = _line_filter(rules_dir)
+
+    assert _filter(literals, FIXTURES / "syslog_chopchopgo_trigger.log", tmp_path) == (
+        b"Mar  2 20:04:38 host kernel.warning rm /var/log/syslog cleared by maintenance script\n"
+    )
+
+
+def test_line_filter_is_case_insensitive_and_honours_and_not(rules_dir, tmp_path):
+    (rules_dir / "promisc.yml").write_text(PROMISC_RULE, encoding="utf-8")
+    log_path = tmp_path / "kernel.log"
+    log_path.write_bytes(
+        b"device eth0 ENTERED PROMISCUOUS MODE\nSystem check completed successfully\n"
+    )
+
+    literals = _line_filter(rules_dir)
+
+    assert _filter(literals, log_path, tmp_path) == b"device eth0 ENTERED PROMISCUOUS MODE\n"
+
+
+def test_line_filter_follows_rule_edits(rules_dir):
+    assert "shred /var/log/syslog" not in _line_filter(rules_dir)
+
+    (rules_dir / "clear_syslog.yml").write_text(
+        CLEAR_SYSLOG_RULE.replace(
+            "    - 'rm /var/log/syslog'\n",
+            "    - 'rm /var/log/syslog'\n    - 'shred /var/log/syslog'\n",
+        ),
+        encoding="utf-8",
+    )
+
+    assert "shred /var/log/syslog" in _line_filter(rules_dir)
+
+
+def test_line_filter_disabled_for_unparseable_rules(rules_dir):
+    (rules_dir / "broken.yml").write_text("detection: [unclosed", encoding="utf-8")
+
+    assert _line_filter(rules_dir) is None
+
+
+def test_write_matching_lines_handles_edge_cases(tmp_path):
+    literals = frozenset({"rm /var/log/syslog"})
+    empty_log = tmp_path / "empty.log"
+    empty_log.write_bytes(b"")
+    unterminated_log = tmp_path / "unterminated.log"
+    unterminated_log.write_bytes(
+        b"a rm /var/log/syslog; rm -r /var/log/syslog\nno match\nb RM /var/log/syslog"
+    )
+
+    assert _filter(literals, empty_log, tmp_path) == b""
+    assert _filter(literals, unterminated_log, tmp_path) == (
+        b"a rm /var/log/syslog; rm -r /var/log/syslog\nb RM /var/log/syslog\n"
+    )
+
+
+def test_write_matching_lines_reports_grep_failures(tmp_path):
+    with pytest.raises(OSError):
+        _filter(frozenset({"syslog"}), tmp_path / "missing.log", tmp_path)
+
+
+@pytest.mark.parametrize(
+    "value, literal",
+    [
+        (r"chmod 777 \*", "chmod 777 *"),
+        (r"*\?query=*", "?query="),
+        (r"C:\\Windows\*", "c:\\windows*"),
+        (r"C:\Users\admin*", "c:\\users\\admin"),
+    ],
+)
+def test_extract_literals_unescapes_wildcards(value, literal):
+    literals = rules.extract_literals(
+        [{"detection": {"keywords": [value], "condition": "keywords"}}]
+    )
+
+    assert literals == {literal}
+
+
+def test_line_filter_keeps_lines_with_escaped_wildcards(rules_dir, tmp_path):
+    (rules_dir / "chmod.yml").write_text(
+        "detection:\n  keywords:\n    - 'chmod 777 \\*'\n  condition: keywords\n",
+        encoding="utf-8",
+    )
+
+    log_path = tmp_path / "shell.log"
+    log_path.write_bytes(
+        b"Mar  2 20:04:38 host sh: chmod 777 *\nMar  2 20:04:39 host sh: chmod 777 x\n"
+    )
+
+    literals = _line_filter(rules_dir)
+
+    assert _filter(literals, log_path, tmp_path) == b"Mar  2 20:04:38 host sh: chmod 777 *\n"
@@ -1,14 +1,17 @@
 import base64
 import json
+import os
+import time
 from pathlib import Path
 from types import SimpleNamespace
 
 import pytest
 
-from src import tasks
+from src import rules, tasks
 
 
 TASK_FN = tasks.analyze_logs.__wrapped__.__func__
+FIXTURES = Path(__file__).resolve().parent / "fixtures"
 
 
 class DummyOutputFile:
@@ -44,6 +47,52 @@ def rules_dir(tmp_path, monkeypatch):
     return rules_root
 
 
+@pytest.fixture
+def fake_chopchopgo(tmp_path, monkeypatch):
+    """Replace the ChopChopGo binary and the OpenRelik file helpers.
+
+    Every ChopChopGo run is recorded with the contents of the file it was
+    given and writes fake.output; other commands (grep) run for real. Each
+    output file is created in a directory of its own.
+    """
+    fake = SimpleNamespace(commands=[], inputs=[], output=b"[]", created_files=[])
+    run = tasks.subprocess.run
+
+    def fake_run(command, stdout, stderr, check, **kwargs):
+        if command[0] == rules.GREP_PATH:
+            return run(command, stdout=stdout, stderr=stderr, check=check, **kwargs)
+        fake.commands.append(command)
+        file_arg_index = command.index("-file") + 1
+        fake.inputs.append(Path(command[file_arg_index]).read_text(encoding="utf-8"))
+        stdout.write(fake.output)
+        return SimpleNamespace(stdout=None, stderr=b"", returncode=0)
+
+    def fake_create_output_file(output_path, display_name, extension, data_type):
+        out_dir = tmp_path / "outputs" / str(len(fake.created_files))
+        out_dir.mkdir(parents=True)
+        fake.created_files.append(out_dir / f"{display_name}.{extension}")
+        return DummyOutputFile(fake.created_files[-1])
+
+    monkeypatch.setattr(tasks.subprocess, "run", fake_run)
+    monkeypatch.setattr(tasks, "create_output_file", fake_create_output_file)
+    monkeypatch.setattr(
+        tasks, "get_input_files", lambda pipe_result, files, filter=None: files
+    )
+    return fake
+
+
+def run_task(tmp_path, input_paths, workflow_id, **task_config):
+    result = TASK_FN(
+        DummyTask(),
+        pipe_result=None,
+        input_files=[{"path": str(path)} for path in input_paths],
+        output_path=str(tmp_path),
+        workflow_id=workflow_id,
+        task_config={"output_format": "json", **task_config},
+    )
+    return json.loads(base64.b64decode(result).decode("utf-8"))
+
+
 def test_analyze_logs_generates_json(tmp_path, tmp_log, rules_dir, monkeypatch):
     task = DummyTask()
 
@@ -68,14 +117,15 @@ def test_analyze_logs_generates_json(tmp_path, tmp_log, rules_dir, monkeypatch):
     recorded_commands = []
 
     class DummyCompletedProcess:
-        def __init__(self, stdout="[]", stderr="", returncode=0):
-            self.stdout = stdout
+        def __init__(self, stderr=b"", returncode=0):
+            self.stdout = None
             self.stderr = stderr
             self.returncode = returncode
 
-    def fake_run(command, capture_output, text, check):
+    def fake_run(command, stdout, stderr, check):
         recorded_commands.append(command)
-        return DummyCompletedProcess(stdout=json.dumps([{"message": "hit"}]))
+        stdout.write(json.dumps([{"message": "hit"}]).encode("utf-8"))
+        return DummyCompletedProcess()
 
     monkeypatch.setattr(tasks.subprocess, "run", fake_run)
 
@@ -115,12 +165,13 @@ def test_analyze_logs_invalid_format_defaults_to_json(tmp_path, tmp_log, rules_d
 
     monkeypatch.setattr(tasks, "create_output_file", fake_create_output_file)
 
-    def fake_run(command, capture_output, text, check):
-        return DummyCompletedProcess(stdout="[]")
+    def fake_run(command, stdout, stderr, check):
+        stdout.write(b"[]")
+        return DummyCompletedProcess()
 
     class DummyCompletedProcess:
-        def __init__(self, stdout="[]", stderr="", returncode=0):
-            self.stdout = stdout
+        def __init__(self, stderr=b"", returncode=0):
+            self.stdout = None
             self.stderr = stderr
             self.returncode = returncode
 
@@ -157,14 +208,15 @@ def test_analyze_logs_none_target_defaults_to_syslog(tmp_path, tmp_log, rules_di
     recorded_commands = []
 
     class DummyCompletedProcess:
-        def __init__(self, stdout="[]", stderr="", returncode=0):
-            self.stdout = stdout
+        def __init__(self, stderr=b"", returncode=0):
+            self.stdout = None
             self.stderr = stderr
             self.returncode = returncode
 
-    def fake_run(command, capture_output, text, check):
+    def fake_run(command, stdout, stderr, check):
         recorded_commands.append(command)
-        return DummyCompletedProcess(stdout="[]")
+        stdout.write(b"[]")
+        return DummyCompletedProcess()
 
     monkeypatch.setattr(tasks.subprocess, "run", fake_run)
 
@@ -201,12 +253,13 @@ def test_rule_bundle_selection_overrides_default(tmp_path, tmp_log, rules_dir, m
 
     class DummyCompletedProcess:
         def __init__(self):
-            self.stdout = "[]"
-            self.stderr = ""
+            self.stdout = None
+            self.stderr = b""
             self.returncode = 0
 
-    def fake_run(command, capture_output, text, check):
+    def fake_run(command, stdout, stderr, check):
         recorded_commands.append(command)
+        stdout.write(b"[]")
         return DummyCompletedProcess()
 
     monkeypatch.setattr(tasks.subprocess, "run", fake_run)
@@ -245,12 +298,13 @@ def test_analyze_logs_none_format_defaults_to_json(tmp_path, tmp_log, rules_dir,
 
     monkeypatch.setattr(tasks, "create_output_file", fake_create_output_file)
 
-    def fake_run(command, capture_output, text, check):
-        return DummyCompletedProcess(stdout="[]")
+    def fake_run(command, stdout, stderr, check):
+        stdout.write(b"[]")
+        return DummyCompletedProcess()
 
     class DummyCompletedProcess:
-        def __init__(self, stdout="[]", stderr="", returncode=0):
-            self.stdout = stdout
+        def __init__(self, stderr=b"", returncode=0):
+            self.stdout = None
             self.stderr = stderr
             self.returncode = returncode
 
@@ -285,12 +339,12 @@ def test_analyze_logs_raises_on_failure(tmp_path, tmp_log, rules_dir, monkeypatc
     monkeypatch.setattr(tasks, "create_output_file", fake_create_output_file)
 
     class DummyCompletedProcess:
-        def __init__(self, stdout="", stderr="boom", returncode=1):
-            self.stdout = stdout
+        def __init__(self, stderr=b"boom", returncode=1):
+            self.stdout = None
             self.stderr = stderr
             self.returncode = returncode
 
-    def fake_run(command, capture_output, text, check):
+    def fake_run(command, stdout, stderr, check):
         return DummyCompletedProcess()
 
     monkeypatch.setattr(tasks.subprocess, "run", fake_run)
@@ -323,8 +377,8 @@ def test_analyze_logs_parse_failure_message(tmp_path, tmp_log, rules_dir, monkey
 
     class DummyCompletedProcess:
         def __init__(self):
-            self.stdout = ""
-            self.stderr = "2025/10/24 18:36:32 Failed to parse events: Failed to match timestamp"
+            self.stdout = None
+            self.stderr = b"2025/10/24 18:36:32 Failed to parse events: Failed to match timestamp"
             self.returncode = 1
 
     monkeypatch.setattr(tasks.subprocess, "run", lambda *a, **k: DummyCompletedProcess())
@@ -340,3 +394,203 @@ def test_analyze_logs_parse_failure_message(tmp_path, tmp_log, rules_dir, monkey
         )
 
     assert "could not parse" in str(exc.value)
+
+
+def test_analyze_logs_processes_multiple_files(tmp_path, rules_dir, fake_chopchopgo, monkeypatch):
+    task = DummyTask()
+
+    log_paths = []
+    for name in ("first.log", "second.log", "third.log"):
+        log_path = tmp_path / name
+        log_path.write_text("example log\n", encoding="utf-8")
+        log_paths.append(log_path)
+
+    monkeypatch.setattr(tasks, "PARALLELISM", 2)
+
+    result = TASK_FN(
+        task,
+        pipe_result=None,
+        input_files=[{"path": str(path)} for path in log_paths],
+        output_path=str(tmp_path),
+        workflow_id="wf-multi",
+        task_config={"output_format": "json"},
+    )
+
+    decoded = json.loads(base64.b64decode(result).decode("utf-8"))
+    assert [Path(entry["path"]).name for entry in decoded["output_files"]] == [
+        "first_chopchopgo.json",
+        "second_chopchopgo.json",
+        "third_chopchopgo.json",
+    ]
+    assert [data["current"] for _, data in task.dispatched] == [1, 2, 3]
+    commands = decoded["meta"]["commands"]
+    assert [command.split(" -file ")[1].split(" ")[0] for command in commands] == [
+        str(path) for path in log_paths
+    ]
+    assert decoded["command"] == decoded["meta"]["commands"][-1]
+
+
+def test_resolve_rules_path_caches_hits_but_not_misses(rules_dir, monkeypatch):
+    tasks._resolve_rules_path_cached.cache_clear()
+
+    assert tasks._resolve_rules_path("syslog", None, "linux/auditd").endswith("linux/auditd")
+    assert tasks._resolve_rules_path("syslog", None, "linux/auditd").endswith("linux/auditd")
+    assert tasks._resolve_rules_path_cached.cache_info().hits == 1
+
+    assert tasks._resolve_rules_path("syslog", None, "linux/file_event").endswith("linux/builtin")
+    (rules_dir / "linux" / "builtin").rmdir()
+    (rules_dir / "linux" / "file_event").mkdir()
+    assert tasks._resolve_rules_path("auditd", str(rules_dir / "missing"), None) is None
+    assert tasks._resolve_rules_path("syslog", None, "linux/file_event").endswith(
+        "linux/file_event"
+    )
+
+
+def test_worker_process_init_resolves_binary_and_bundles(tmp_path, rules_dir, monkeypatch):
+    binary = tmp_path / "bin" / "chopchopgo"
+    binary.parent.mkdir()
+    binary.write_text("#!/bin/sh\n", encoding="utf-8")
+    binary.chmod(0o755)
+
+    monkeypatch.setattr(tasks, "BINARY_PATH", "chopchopgo")
+    monkeypatch.setenv("PATH", str(binary.parent))
+    monkeypatch.setattr(tasks, "_BINARY_ABS", None)
+    monkeypatch.setattr(tasks, "_BUNDLE_ROOT", None)
+    monkeypatch.setattr(tasks, "_BUNDLE_DIRS", None)
+
+    tasks.on_worker_process_init()
+
+    assert tasks._BINARY_ABS == str(binary)
+    assert tasks._build_command("syslog", "rules", "input.log", "json")[0] == str(binary)
+    assert sorted(tasks._BUNDLE_DIRS) == ["linux/auditd", "linux/builtin"]
+
+    # Bundles seen at start-up are trusted without touching the filesystem.
+    (rules_dir / "linux" / "auditd").rmdir()
+    assert tasks._resolve_rules_path("auditd", None, None).endswith("linux/auditd")
+
+    # Bundles missing at start-up are looked for again and remembered once found.
+    assert tasks._resolve_rules_path("syslog", None, "linux/file_event").endswith(
+        "linux/builtin"
+    )
+    (rules_dir / "linux" / "file_event").mkdir()
+    assert tasks._resolve_rules_path("syslog", None, "linux/file_event").endswith(
+        "linux/file_event"
+    )
+    assert "linux/file_event" in tasks._BUNDLE_DIRS
+    tasks._resolve_rules_path_cached.cache_clear()
+
+
+def test_prefilter_passes_only_candidate_lines(tmp_path, rules_dir, fake_chopchopgo, monkeypatch):
+    (rules_dir / "linux" / "builtin" / "clear_syslog.yml").write_text(
+        "detection:\n  keywords:\n    - 'rm /var/log/syslog'\n  condition: keywords\n",
+        encoding="utf-8",
+    )
+    log_path = tmp_path / "syslog.log"
+    log_path.write_text(
+        "Mar  2 20:04:38 host kernel.warning rm /var/log/syslog\n"
+        "Mar  2 20:05:00 host kernel.info System check completed successfully\n",
+        encoding="utf-8",
+    )
+    monkeypatch.setattr(tasks, "PREFILTER", True)
+
+    decoded = run_task(tmp_path, [log_path], "wf-prefilter", target="syslog")
+
+    assert fake_chopchopgo.inputs == ["Mar  2 20:04:38 host kernel.warning rm /var/log/syslog\n"]
+    assert f"-file {log_path}" in decoded["meta"]["commands"][0]
+
+
+def test_progress_events_are_coalesced(monkeypatch):
+    task = DummyTask()
+    files = [{"path": f"/logs/{index}.log"} for index in range(45)]
+
+    monkeypatch.setattr(
+        tasks,
+        "_process_one",
+        lambda input_file, *args: {
+            "display_name": input_file["path"],
+            "output_file": {"path": input_file["path"]},
+            "command": ["chopchopgo"],
+        },
+    )
+
+    processed = tasks._process_files(task, files, "syslog", "rules", "json", None)
+
+    assert len(processed) == 45
+    currents = [data["current"] for _, data in task.dispatched]
+    assert currents == list(range(2, 45, 2)) + [45]
+
+
+def test_cached_output_is_reused_for_identical_input(
+    tmp_path, tmp_log, rules_dir, fake_chopchopgo, monkeypatch
+):
+    monkeypatch.setattr(tasks, "CACHE_DIR", str(tmp_path / "cache"))
+    fake_chopchopgo.output = json.dumps([{"message": "hit"}]).encode("utf-8")
+
+    for workflow_id in ("wf-cache-1", "wf-cache-2"):
+        run_task(tmp_path, [tmp_log], workflow_id)
+
+    assert len(fake_chopchopgo.commands) == 1, "The second run should be served from the cache"
+    assert [path.read_text(encoding="utf-8") for path in fake_chopchopgo.created_files] == [
+        json.dumps([{"message": "hit"}])
+    ] * 2
+    assert len(list((tmp_path / "cache").iterdir())) == 1
+
+
+def test_cache_is_invalidated_when_a_rule_is_edited_in_place(
+    tmp_path, tmp_log, rules_dir, fake_chopchopgo, monkeypatch
+):
+    monkeypatch.setattr(tasks, "CACHE_DIR", str(tmp_path / "cache"))
+
+    rule_file = rules_dir / "linux" / "builtin" / "rule.yml"
+    rules_mtime = os.stat(rules_dir / "linux" / "builtin").st_mtime_ns
+    for workflow_id, rule in (("wf-edit-1", "title: one\n"), ("wf-edit-2", "title: second\n")):
+        rule_file.write_text(rule, encoding="utf-8")
+        # Editing a file in place leaves the directory mtime untouched.
+        os.utime(rules_dir / "linux" / "builtin", ns=(rules_mtime, rules_mtime))
+        run_task(tmp_path, [tmp_log], workflow_id)
+
+    assert len(fake_chopchopgo.commands) == 2
+
+
+def test_cache_entries_expire_unless_used(tmp_path, monkeypatch):
+    cache_dir = tmp_path / "cache"
+    cache_dir.mkdir()
+    monkeypatch.setattr(tasks, "CACHE_DIR", str(cache_dir))
+    monkeypatch.setattr(tasks, "_CACHE_PRUNED_AT", None)
+    expired_at = time.time() - (tasks.CACHE_MAX_AGE_DAYS + 1) * 86400
+    for name in ("stale", "reused", "fresh"):
+        (cache_dir / name).write_bytes(b"[]")
+    for name in ("stale", "reused"):
+        os.utime(cache_dir / name, (expired_at, expired_at))
+
+    assert tasks._restore_cached_output("reused", str(tmp_path / "output.json"))
+    tasks._prune_cache()
+
+    assert sorted(path.name for path in cache_dir.iterdir()) == ["fresh", "reused"]
+    assert not tasks._restore_cached_output("stale", str(tmp_path / "missing.json"))
+
+
+def test_compatible_inputs_accept_all_fixtures():
+    input_files = [
+        {"path": str(path), "display_name": path.name} for path in sorted(FIXTURES.iterdir())
+    ]
+
+    assert tasks.get_input_files(None, input_files, filter=tasks.COMPATIBLE_INPUTS) == input_files
+
+
+def test_parse_config_normalizes_values_once():
+    config = tasks._parse_config(
+        {
+            "output_format": [" CSV "],
+            "target": [],
+            "rule_bundle": ["linux/auditd", "linux/builtin"],
+            "rules_path": {"unexpected": "mapping"},
+        }
+    )
+
+    assert config == tasks._TaskConfig(
+        output_format="csv",
+        target="syslog",
+        rules_override=None,
+        bundle_choice="linux/auditd",
+    )